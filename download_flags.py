@@ -6,18 +6,60 @@ Source: https://en.wikipedia.org/wiki/List_of_national_flags_of_sovereign_states
 
 import os
 import sys
+import argparse
+import re
+import shutil
 import requests
+import urllib3
 from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
+from selectolax.lexbor import LexborHTMLParser
 from urllib.parse import urljoin, urlparse
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
-from io import BytesIO
+from wiki_cache import SESSION, get_wikipedia_page, load_parsed, save_parsed
 
 # Configuration
-WIKIPEDIA_URL = "https://en.wikipedia.org/wiki/List_of_national_flags_of_sovereign_states"
 OUTPUT_DIR = "flags"
-REQUEST_DELAY = 0.5  # Delay between requests to be respectful to Wikipedia's servers
+REQUEST_DELAY = 0.25  # Minimum delay between requests to be respectful to Wikipedia's servers
+MAX_WORKERS = 8  # Number of parallel image downloads
 MAX_IMAGE_SIZE = 600  # Maximum width or height in pixels
+FLAG_FORMAT = "JPEG"  # Format for images that have to be re-encoded locally ("JPEG" or "PNG")
+FLAG_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png"}
+FLAG_IMAGES_CACHE_VERSION = 1  # Bump whenever the output of extract_flag_images changes
+# Characters that are not allowed in filenames, mapped to '_'
+INVALID_FILENAME_CHARS = str.maketrans({char: '_' for char in '<>:"/\\|?*'})
+# Matches the size component of a Wikimedia thumbnail of an SVG original,
+# e.g. ".../Flag_of_X.svg/125px-Flag_of_X.svg.png"
+SVG_THUMB_SIZE_RE = re.compile(r'/\d+px-(?=[^/]+\.svg\.png$)')
+# Images with a src inside a row of any table whose class list contains 'wikitable'
+FLAG_IMAGES_CSS = "table.wikitable tr img[src]"
+FLAG_IMAGES_XPATH = etree.XPath("//table[contains(concat(' ', normalize-space(@class), ' '), ' wikitable ')]//tr//img[@src != '']")
+
+
+class RateLimiter:
+    """Space out requests across all threads so at most one starts every `interval` seconds."""
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+    
+    def wait(self):
+        """Block until the caller is allowed to issue its next request."""
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+# Shared by all download workers so the global request rate stays bounded
+RATE_LIMITER = RateLimiter(REQUEST_DELAY)
 
 
 def create_output_directory():
@@ -27,111 +69,208 @@ def create_output_directory():
         print(f"Created directory: {OUTPUT_DIR}")
 
 
-def get_wikipedia_page():
-    """Fetch the Wikipedia page content."""
-    print(f"Fetching page: {WIKIPEDIA_URL}")
-    headers = {
-        'User-Agent': 'AnkiVexillologyBot/1.0 (Educational purposes; downloading flag images)'
-    }
-    response = requests.get(WIKIPEDIA_URL, headers=headers)
-    response.raise_for_status()
-    return response.text
+def list_existing_files():
+    """Return the names of the files already in the output directory, using a single scan."""
+    with os.scandir(OUTPUT_DIR) as entries:
+        return {entry.name for entry in entries if entry.is_file()}
 
 
-def extract_flag_images(html_content):
-    """Extract flag image URLs from the Wikipedia page."""
-    soup = BeautifulSoup(html_content, 'html.parser')
+def _flag_image_entry(src, alt_text, width, height):
+    """Build a flag image entry from an <img> tag's attributes, or None if it isn't a flag."""
+    # Convert relative URLs to absolute URLs
+    img_url = urljoin('https:', src)
+    
+    # Only include images that look like flags (larger than icons)
+    try:
+        if int(width) >= 100:  # Filter out small icons
+            return {
+                'url': img_url,
+                'alt': alt_text,
+                'width': width,
+                'height': height
+            }
+    except (ValueError, TypeError):
+        # If width is not a number, check if it's a flag image
+        # Be more restrictive: require 'Flag_of_' in URL or 'flag of' in alt text
+        if 'Flag_of_' in img_url or 'flag of' in alt_text.lower():
+            return {
+                'url': img_url,
+                'alt': alt_text,
+                'width': width,
+                'height': height
+            }
+    return None
+
+
+def _extract_flag_images_selectolax(images):
+    """Build flag image entries from <img> nodes selected with selectolax (Lexbor)."""
+    flag_images = []
+    
+    for img in images:
+        attrs = img.attributes
+        # Attributes without a value (e.g. a bare "alt") come back as None
+        src = attrs.get('src')
+        if src:
+            entry = _flag_image_entry(src, attrs.get('alt') or '', attrs.get('width', '0') or '', attrs.get('height', '0') or '')
+            if entry:
+                flag_images.append(entry)
+    
+    return flag_images
+
+
+def extract_flag_images_lxml(root):
+    """Extract flag images from a document already parsed with lxml (e.g. lxml.html.fromstring)."""
     flag_images = []
     
-    # Find all tables with class 'wikitable'
-    tables = soup.find_all('table', class_='wikitable')
-    
-    for table in tables:
-        rows = table.find_all('tr')
-        for row in rows:
-            # Find images in the row
-            images = row.find_all('img')
-            for img in images:
-                if img.get('src'):
-                    # Convert relative URLs to absolute URLs
-                    img_url = urljoin('https:', img['src'])
-                    # Get the alt text for the filename
-                    alt_text = img.get('alt', '')
-                    
-                    # Only include images that look like flags (larger than icons)
-                    width = img.get('width', '0')
-                    try:
-                        if int(width) >= 100:  # Filter out small icons
-                            flag_images.append({
-                                'url': img_url,
-                                'alt': alt_text,
-                                'width': width
-                            })
-                    except (ValueError, TypeError):
-                        # If width is not a number, check if it's a flag image
-                        # Be more restrictive: require 'Flag_of_' in URL or 'flag of' in alt text
-                        if 'Flag_of_' in img_url or 'flag of' in alt_text.lower():
-                            flag_images.append({
-                                'url': img_url,
-                                'alt': alt_text,
-                                'width': width
-                            })
+    # Find every image inside a row of a 'wikitable' table in one query, evaluated by libxml2
+    images = FLAG_IMAGES_XPATH(root)
+    
+    for img in images:
+        entry = _flag_image_entry(img.get('src'), img.get('alt', ''), img.get('width', '0'), img.get('height', '0'))
+        if entry:
+            flag_images.append(entry)
     
     return flag_images
 
 
+def _extract_flag_images_bs4(html_content):
+    """Extract flag images using BeautifulSoup (slower, but more forgiving)."""
+    soup = BeautifulSoup(html_content, 'lxml')
+    flag_images = []
+    
+    # Find every image inside a row of a 'wikitable' table with one selector
+    for img in soup.select(FLAG_IMAGES_CSS):
+        if img.get('src'):
+            entry = _flag_image_entry(img['src'], img.get('alt', ''), img.get('width', '0'), img.get('height', '0'))
+            if entry:
+                flag_images.append(entry)
+    
+    return flag_images
+
+
+def extract_flag_images(html_content):
+    """Extract flag image URLs from the Wikipedia page."""
+    # Only the parsers are guarded, so bugs in the shared entry logic are not
+    # mistaken for parse failures and hidden behind the slower fallbacks
+    try:
+        # selectolax (Lexbor) is the fastest available parser
+        images = LexborHTMLParser(html_content).css(FLAG_IMAGES_CSS)
+    except Exception as e:
+        print(f"Warning: selectolax could not parse page ({e}), falling back to lxml")
+    else:
+        return _extract_flag_images_selectolax(images)
+    
+    try:
+        root = lxml.html.fromstring(html_content)
+    except (etree.ParserError, ValueError) as e:
+        # lxml refuses some inputs (e.g. empty documents); fall back to BeautifulSoup
+        print(f"Warning: lxml could not parse page ({e}), falling back to BeautifulSoup")
+        return _extract_flag_images_bs4(html_content)
+    return extract_flag_images_lxml(root)
+
+
 def sanitize_filename(filename):
     """Sanitize filename to remove invalid characters."""
-    # Remove or replace invalid characters
-    invalid_chars = '<>:"/\\|?*'
-    for char in invalid_chars:
-        filename = filename.replace(char, '_')
-    return filename
+    # Replace invalid characters in a single pass
+    return filename.translate(INVALID_FILENAME_CHARS)
 
 
-def resize_image(image_data, max_size=MAX_IMAGE_SIZE):
-    """Resize an image to fit within max_size while maintaining aspect ratio."""
+def resize_image(source_path, dest_path, max_size=MAX_IMAGE_SIZE):
+    """
+    Resize the image at source_path to fit within max_size while maintaining
+    aspect ratio, writing the result to dest_path. source_path is consumed.
+    
+    Re-encoded images are saved as FLAG_FORMAT, which may change the extension
+    of dest_path. Returns the path that was actually written.
+    """
     try:
-        img = Image.open(BytesIO(image_data))
-        
-        # Convert RGBA to RGB for storage optimization (reduces file size)
-        if img.mode == 'RGBA':
-            # Create a white background and paste with alpha mask
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[3])
-            img = background
-        elif img.mode not in ('RGB', 'L'):
-            img = img.convert('RGB')
-        
-        # Check if resizing is needed
-        width, height = img.size
-        if width <= max_size and height <= max_size:
-            # No resizing needed, return original data
-            return image_data
-        
-        # Calculate new dimensions maintaining aspect ratio
-        if width > height:
-            new_width = max_size
-            new_height = int((max_size / width) * height)
-        else:
-            new_height = max_size
-            new_width = int((max_size / height) * width)
-        
-        # Resize image using high-quality LANCZOS resampling
-        img = img.resize((new_width, new_height), Image.LANCZOS)
-        
-        # Save to bytes
-        output = BytesIO()
-        img.save(output, format='PNG', optimize=True)
-        return output.getvalue()
+        with Image.open(source_path) as img:
+            # Check if resizing is needed (only the header has been read so far)
+            width, height = img.size
+            if width <= max_size and height <= max_size:
+                # No resizing needed, keep original file
+                img.close()
+                os.replace(source_path, dest_path)
+                return dest_path
+            
+            # Convert RGBA to RGB for storage optimization (reduces file size)
+            if img.mode == 'RGBA':
+                # Create a white background and paste with alpha mask
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[3])
+                img = background
+            elif img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            
+            # Calculate new dimensions maintaining aspect ratio
+            if width > height:
+                new_width = max_size
+                new_height = int((max_size / width) * height)
+            else:
+                new_height = max_size
+                new_width = int((max_size / height) * width)
+            
+            # Resize image using high-quality LANCZOS resampling
+            img = img.resize((new_width, new_height), Image.LANCZOS)
+            
+            # The image is flattened to RGB above, so flags lose nothing by being
+            # stored as JPEG, which encodes much faster and smaller than optimized PNG
+            output_path = os.path.splitext(dest_path)[0] + FLAG_EXTENSIONS[FLAG_FORMAT]
+            if FLAG_FORMAT == 'JPEG':
+                img.save(output_path, format='JPEG', quality=90, progressive=True)
+            else:
+                img.save(output_path, format='PNG', optimize=True)
+        os.remove(source_path)
+        return output_path
     except Exception as e:
         print(f"    Warning: Could not resize image: {e}")
-        # Return original data if resize fails
-        return image_data
+        # Keep original file if resize fails
+        os.replace(source_path, dest_path)
+        return dest_path
+
+
+def get_thumbnail_width(img_data, max_size=MAX_IMAGE_SIZE):
+    """Pick a thumbnail width that keeps both sides of the flag within max_size."""
+    try:
+        width = int(img_data.get('width'))
+        height = int(img_data.get('height'))
+    except (ValueError, TypeError):
+        return max_size
+    if height > width:
+        # Tall flags are limited by their height; the +1 absorbs rounding in the
+        # page's thumbnail dimensions so the rendered height never exceeds max_size
+        return max(1, (max_size * width) // (height + 1))
+    return max_size
 
 
-def download_image(img_data, index):
-    """Download a single flag image."""
+def get_thumbnail_url(url, size=MAX_IMAGE_SIZE):
+    """
+    Rewrite a Wikimedia SVG thumbnail URL to ask for a `size` px wide rendering,
+    so the server delivers an image that already fits and no local resize is needed.
+    Note this enlarges the ~125px thumbnails linked from the list page to `size` px.
+    Other URLs are returned unchanged (raster originals cannot be scaled up).
+    """
+    return SVG_THUMB_SIZE_RE.sub(f'/{size}px-', url)
+
+
+def stream_to_file(url, filepath):
+    """Download url to filepath, streaming the body straight to disk."""
+    # Be respectful to Wikipedia's servers
+    RATE_LIMITER.wait()
+    with SESSION.get(url, timeout=10, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        with open(filepath, 'wb') as f:
+            shutil.copyfileobj(response.raw, f)
+
+
+def download_image(img_data, index, existing_files=None):
+    """
+    Download a single flag image.
+    
+    existing_files is an optional set of file names already in OUTPUT_DIR; when
+    given, it is used instead of checking the filesystem for each image.
+    """
     url = img_data['url']
     alt_text = img_data['alt']
     
@@ -158,32 +297,86 @@ def download_image(img_data, index):
     filename = f"{index:03d}_{filename}"
     
     filepath = os.path.join(OUTPUT_DIR, filename)
+    # Partial downloads go to a temporary file so an interrupted run never leaves a truncated image
+    temp_path = filepath + '.part'
     
-    # Skip if already downloaded
-    if os.path.exists(filepath):
+    # Skip if already downloaded (possibly re-encoded under a different extension)
+    reencoded_filename = os.path.splitext(filename)[0] + FLAG_EXTENSIONS[FLAG_FORMAT]
+    if existing_files is None:
+        already_exists = (os.path.exists(filepath) or
+                          os.path.exists(os.path.join(OUTPUT_DIR, reencoded_filename)))
+    else:
+        already_exists = filename in existing_files or reencoded_filename in existing_files
+    if already_exists:
         print(f"  Skipping (already exists): {filename}")
         return True
     
     try:
         print(f"  Downloading: {filename}")
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
+        thumbnail_url = get_thumbnail_url(url, get_thumbnail_width(img_data))
+        if thumbnail_url != url:
+            # The server renders the thumbnail at the right size, so it is saved as-is
+            try:
+                stream_to_file(thumbnail_url, temp_path)
+                os.replace(temp_path, filepath)
+                return True
+            except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+                # Copying response.raw reads urllib3's stream directly, so a connection
+                # dropped mid-body raises urllib3 errors rather than requests ones
+                print(f"    Thumbnail unavailable ({e}), falling back to original")
+        
+        stream_to_file(url, temp_path)
         
         # Resize the image
         print(f"    Resizing to max {MAX_IMAGE_SIZE}px...")
-        resized_data = resize_image(response.content)
-        
-        with open(filepath, 'wb') as f:
-            f.write(resized_data)
+        resize_image(temp_path, filepath)
         
         return True
     except Exception as e:
         print(f"  Error downloading {filename}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
         return False
 
 
+def download_all(flag_images, existing_files=None):
+    """Download all flag images in parallel. Returns (success_count, fail_count)."""
+    success_count = 0
+    fail_count = 0
+    
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(download_image, img_data, index, existing_files)
+            for index, img_data in enumerate(flag_images, start=1)
+        ]
+        try:
+            for future in as_completed(futures):
+                if future.result():
+                    success_count += 1
+                else:
+                    fail_count += 1
+        except KeyboardInterrupt:
+            # Leaving the with block waits for the pool, so drop the queued downloads
+            # first; only the ones already in progress get to finish
+            print("\nInterrupted, cancelling pending downloads...")
+            for future in futures:
+                future.cancel()
+            raise
+    
+    return success_count, fail_count
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Download national flags from Wikipedia.")
+    parser.add_argument('--refresh', action='store_true',
+                        help="ignore the cached Wikipedia page and flag list and fetch them again")
+    return parser.parse_args()
+
+
 def main():
     """Main function to orchestrate the download process."""
+    args = parse_args()
     print("Starting flag download process...")
     
     # Create output directory
@@ -191,14 +384,17 @@ def main():
     
     # Fetch Wikipedia page
     try:
-        html_content = get_wikipedia_page()
+        html_content = get_wikipedia_page(refresh=args.refresh)
     except Exception as e:
         print(f"Error fetching Wikipedia page: {e}")
         sys.exit(1)
     
-    # Extract flag images
+    # Extract flag images (reusing the previous result if the page is unchanged)
     print("Extracting flag image URLs...")
-    flag_images = extract_flag_images(html_content)
+    flag_images = None if args.refresh else load_parsed('flag_images', html_content, FLAG_IMAGES_CACHE_VERSION)
+    if flag_images is None:
+        flag_images = extract_flag_images(html_content)
+        save_parsed('flag_images', html_content, FLAG_IMAGES_CACHE_VERSION, flag_images)
     print(f"Found {len(flag_images)} flag images")
     
     if not flag_images:
@@ -207,17 +403,8 @@ def main():
     
     # Download images
     print(f"\nDownloading {len(flag_images)} flag images...")
-    success_count = 0
-    fail_count = 0
-    
-    for index, img_data in enumerate(flag_images, start=1):
-        if download_image(img_data, index):
-            success_count += 1
-        else:
-            fail_count += 1
-        
-        # Be respectful to Wikipedia's servers
-        time.sleep(REQUEST_DELAY)
+    existing_files = list_existing_files()
+    success_count, fail_count = download_all(flag_images, existing_files)
     
     # Summary
     print(f"\n{'='*60}")
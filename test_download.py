@@ -3,7 +3,21 @@
 Test script to verify the flag download functionality with mock data.
 """
 
-from download_flags import extract_flag_images, sanitize_filename
+import contextlib
+import functools
+import io
+import json
+import tempfile
+import threading
+import time
+import types
+import lxml.html
+import requests
+import urllib3
+from PIL import Image
+import download_flags
+import wiki_cache
+from download_flags import extract_flag_images, extract_flag_images_lxml, sanitize_filename, get_thumbnail_url, get_thumbnail_width
 import os
 
 # Mock HTML content that simulates the Wikipedia page structure
@@ -35,38 +49,134 @@ MOCK_HTML = """
 </html>
 """
 
+# (input, expected) pairs for sanitize_filename
+SANITIZE_CASES = [
+    ("Flag of Afghanistan", "Flag of Afghanistan"),
+    ("Flag: Test/Name", "Flag_ Test_Name"),
+    ('Flag "with" quotes', "Flag _with_ quotes"),
+    ("Flag<>Test", "Flag__Test"),
+]
+
+
+class FakeResponse:
+    """Minimal stand-in for a requests.Response returned by SESSION.get."""
+    
+    def __init__(self, status_code=200, content=b'', headers=None, raw=None):
+        self.status_code = status_code
+        self.text = content.decode('utf-8', 'replace')
+        self.headers = headers or {}
+        self.raw = raw if raw is not None else io.BytesIO(content)
+    
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error")
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+
+
+@contextlib.contextmanager
+def in_temp_dir():
+    """Run the block inside a fresh temporary working directory (flags/ and cache/ are relative)."""
+    old_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.chdir(temp_dir)
+        try:
+            yield temp_dir
+        finally:
+            os.chdir(old_cwd)
+
+
+@contextlib.contextmanager
+def stub_session_get(fake_get):
+    """Route SESSION.get to fake_get for the duration of the block, recording every call."""
+    calls = []
+    
+    def recording_get(url, **kwargs):
+        calls.append((url, kwargs))
+        return fake_get(url, **kwargs)
+    
+    wiki_cache.SESSION.get = recording_get
+    try:
+        yield calls
+    finally:
+        # Drop the instance attribute so the real Session.get is used again
+        del wiki_cache.SESSION.get
+
+
+@functools.lru_cache(maxsize=1)
+def mock_flag_images():
+    """
+    Extract flag images from MOCK_HTML once and share the result between tests.
+    The entries are read-only views so one test cannot change what another sees.
+    """
+    return tuple(types.MappingProxyType(img) for img in extract_flag_images(MOCK_HTML))
+
 
 def test_extract_flag_images():
     """Test flag image extraction from HTML."""
     print("Testing flag image extraction...")
-    flag_images = extract_flag_images(MOCK_HTML)
+    flag_images = mock_flag_images()
     
-    print(f"Found {len(flag_images)} flag images")
     assert len(flag_images) == 3, f"Expected 3 images, found {len(flag_images)}"
     
     # Check that URLs are properly formatted
     for img in flag_images:
-        print(f"  - {img['alt']}: {img['url']}")
-        assert img['url'].startswith('https://'), f"URL should start with https://"
-        assert 'Flag' in img['url'], f"URL should contain 'Flag'"
+        assert img['url'].startswith('https://'), f"URL should start with https://: {img['url']}"
+        assert 'Flag' in img['url'], f"URL should contain 'Flag': {img['url']}"
     
     print("✓ Flag image extraction test passed")
 
 
+def test_extract_flag_images_lxml():
+    """Test flag image extraction from a pre-parsed lxml tree."""
+    print("\nTesting flag image extraction from an lxml tree...")
+    flag_images = extract_flag_images_lxml(lxml.html.fromstring(MOCK_HTML))
+    
+    assert tuple(flag_images) == mock_flag_images(), "lxml tree extraction should match extract_flag_images"
+    
+    print("✓ lxml tree extraction test passed")
+
+
+def test_extract_flag_images_fallback():
+    """Test that the BeautifulSoup fallback finds the same flags as the fast path."""
+    print("\nTesting BeautifulSoup fallback extraction...")
+    
+    assert tuple(download_flags._extract_flag_images_bs4(MOCK_HTML)) == mock_flag_images(), \
+        "Fallback extraction should match extract_flag_images"
+    # An empty page is rejected by lxml.html and handled by the fallback
+    assert download_flags._extract_flag_images_bs4("") == [], "Empty page should yield no flags"
+    
+    print("✓ Fallback extraction test passed")
+
+
+def test_extract_flag_images_skips_empty_src():
+    """Test that images without a usable src are ignored by every backend."""
+    print("\nTesting extraction of images with an empty src...")
+    html = MOCK_HTML.replace(
+        "<td>Algeria</td>",
+        '<td>Algeria <img src="" alt="Flag of Nowhere" width="150" height="100" /></td>'
+    )
+    
+    for flag_images in (extract_flag_images(html),
+                        extract_flag_images_lxml(lxml.html.fromstring(html)),
+                        download_flags._extract_flag_images_bs4(html)):
+        assert len(flag_images) == 3, f"Expected 3 images, found {len(flag_images)}"
+        assert all(img['url'] != 'https:' for img in flag_images), "Empty src should not become a URL"
+    
+    print("✓ Empty src extraction test passed")
+
+
 def test_sanitize_filename():
     """Test filename sanitization."""
     print("\nTesting filename sanitization...")
     
-    test_cases = [
-        ("Flag of Afghanistan", "Flag of Afghanistan"),
-        ("Flag: Test/Name", "Flag_ Test_Name"),
-        ('Flag "with" quotes', "Flag _with_ quotes"),
-        ("Flag<>Test", "Flag__Test"),
-    ]
-    
-    for input_name, expected_start in test_cases:
+    for input_name, expected in SANITIZE_CASES:
         result = sanitize_filename(input_name)
-        print(f"  '{input_name}' -> '{result}'")
+        assert result == expected, f"{input_name!r} -> {result!r}, expected {expected!r}"
         assert '/' not in result, "Should not contain /"
         assert ':' not in result, "Should not contain :"
         assert '<' not in result, "Should not contain <"
@@ -75,13 +185,249 @@ def test_sanitize_filename():
     print("✓ Filename sanitization test passed")
 
 
+def test_get_thumbnail_url():
+    """Test rewriting Wikimedia thumbnail URLs to the target size."""
+    print("\nTesting thumbnail URL rewriting...")
+    
+    svg_thumb = "https://upload.wikimedia.org/wikipedia/commons/thumb/5/5c/Flag_of_Afghanistan.svg/125px-Flag_of_Afghanistan.svg.png"
+    expected = "https://upload.wikimedia.org/wikipedia/commons/thumb/5/5c/Flag_of_Afghanistan.svg/600px-Flag_of_Afghanistan.svg.png"
+    assert get_thumbnail_url(svg_thumb, 600) == expected, "SVG thumbnail should be requested at 600px"
+    
+    # Raster originals cannot be scaled up, so they are left alone
+    png_thumb = "https://upload.wikimedia.org/wikipedia/commons/thumb/1/1a/Flag_of_Nowhere.png/125px-Flag_of_Nowhere.png"
+    assert get_thumbnail_url(png_thumb, 600) == png_thumb, "Raster thumbnail should be unchanged"
+    
+    # Wide flags are limited by width, tall flags by height
+    assert get_thumbnail_width({'width': '125', 'height': '83'}, 600) == 600
+    tall_width = get_thumbnail_width({'width': '82', 'height': '100'}, 600)
+    assert tall_width == 487, f"Expected 487px for a 82x100 flag, got {tall_width}"
+    assert tall_width * 100 / 82 <= 600, "Rendered height should stay within 600px"
+    assert get_thumbnail_width({'width': 'auto', 'height': '100'}, 600) == 600
+    
+    print("✓ Thumbnail URL rewriting test passed")
+
+
+def test_fetch_with_cache():
+    """Test caching and conditional GETs in fetch_with_cache."""
+    print("\nTesting page cache and conditional GETs...")
+    url = "https://en.wikipedia.org/wiki/Example"
+    
+    with in_temp_dir():
+        # First fetch downloads the page and stores its body and ETag
+        with stub_session_get(lambda url, **kwargs: FakeResponse(200, b"<html>v1</html>", {'ETag': '"v1"'})) as calls:
+            assert wiki_cache.fetch_with_cache(url, max_age=3600) == "<html>v1</html>"
+        assert calls[0][1]['headers'] == {}, "First fetch should not send validators"
+        entry = wiki_cache.load_etag_cache()[url]
+        assert entry['etag'] == '"v1"', "ETag should be stored"
+        assert os.path.exists(entry['body_path']), "Body should be written to disk"
+        
+        # A fresh copy is returned without any request
+        with stub_session_get(lambda url, **kwargs: FakeResponse(500)) as calls:
+            assert wiki_cache.fetch_with_cache(url, max_age=3600) == "<html>v1</html>"
+        assert calls == [], "Fresh cached copy should not hit the network"
+        
+        # A stale copy is revalidated, and 304 returns the cached body
+        with stub_session_get(lambda url, **kwargs: FakeResponse(304)) as calls:
+            assert wiki_cache.fetch_with_cache(url, max_age=0) == "<html>v1</html>"
+        assert calls[0][1]['headers'] == {'If-None-Match': '"v1"'}, "Stale copy should send If-None-Match"
+        
+        # refresh=True ignores the cache and sends no validators
+        with stub_session_get(lambda url, **kwargs: FakeResponse(200, b"<html>v2</html>", {'ETag': '"v2"'})) as calls:
+            assert wiki_cache.fetch_with_cache(url, max_age=3600, refresh=True) == "<html>v2</html>"
+        assert calls[0][1]['headers'] == {}, "Refresh should not send validators"
+        assert wiki_cache.load_etag_cache()[url]['etag'] == '"v2"', "Refresh should store the new ETag"
+        
+        # A malformed etags.json is treated as empty and the page is fetched again
+        for contents in ('not json', '[]', json.dumps({url: {'etag': '"v2"'}}), json.dumps({url: "text"})):
+            with open(wiki_cache.ETAG_CACHE_FILE, 'w', encoding='utf-8') as f:
+                f.write(contents)
+            with stub_session_get(lambda url, **kwargs: FakeResponse(200, b"<html>v3</html>", {'ETag': '"v3"'})) as calls:
+                assert wiki_cache.fetch_with_cache(url, max_age=3600) == "<html>v3</html>", f"{contents!r} should refetch"
+            assert calls[0][1]['headers'] == {}, f"{contents!r} should not send validators"
+    
+    print("✓ Page cache test passed")
+
+
+def test_parsed_cache():
+    """Test that cached parse results are tied to the page content and parser version."""
+    print("\nTesting parsed result cache...")
+    flag_images = [dict(img) for img in mock_flag_images()]
+    
+    with in_temp_dir():
+        assert wiki_cache.load_parsed('flag_images', MOCK_HTML, 1) is None, "Empty cache should miss"
+        
+        wiki_cache.save_parsed('flag_images', MOCK_HTML, 1, flag_images)
+        assert wiki_cache.load_parsed('flag_images', MOCK_HTML, 1) == flag_images, "Saved result should be returned"
+        assert wiki_cache.load_parsed('flag_images', MOCK_HTML, 2) is None, "New parser version should miss"
+        assert wiki_cache.load_parsed('flag_images', MOCK_HTML + " ", 1) is None, "Changed page should miss"
+        
+        # Unreadable or unexpected cache files are treated as a miss
+        for contents in ('not json', '[1, 2, 3]', '"text"'):
+            with open(os.path.join(wiki_cache.CACHE_DIR, 'flag_images.json'), 'w', encoding='utf-8') as f:
+                f.write(contents)
+            assert wiki_cache.load_parsed('flag_images', MOCK_HTML, 1) is None, f"{contents!r} should miss"
+    
+    print("✓ Parsed result cache test passed")
+
+
+def _png_bytes(width, height):
+    """Return a PNG image of the given size as bytes."""
+    output = io.BytesIO()
+    Image.new('RGBA', (width, height), (200, 16, 46, 255)).save(output, format='PNG')
+    return output.getvalue()
+
+
+class _FailingRaw(io.RawIOBase):
+    """A response body whose connection drops as soon as it is read."""
+    
+    def __init__(self, error=None):
+        super().__init__()
+        self.error = error or OSError("connection reset")
+    
+    def readinto(self, buffer):
+        raise self.error
+
+
+def test_download_image():
+    """Test downloading, re-encoding and skipping flag images."""
+    print("\nTesting image download and resize...")
+    img_data = {'url': 'https://upload.wikimedia.org/wikipedia/commons/a/a1/x.png', 'alt': 'x'}
+    interval = download_flags.RATE_LIMITER.interval
+    download_flags.RATE_LIMITER.interval = 0
+    try:
+        with in_temp_dir():
+            download_flags.create_output_directory()
+        
+            # A 1200x800 raster image is resized locally and re-encoded as JPEG
+            with stub_session_get(lambda url, **kwargs: FakeResponse(200, _png_bytes(1200, 800))):
+                assert download_flags.download_image(img_data, 1), "Download should succeed"
+            assert sorted(os.listdir('flags')) == ['001_x.jpg'], f"Unexpected files: {os.listdir('flags')}"
+            with Image.open(os.path.join('flags', '001_x.jpg')) as img:
+                assert img.size == (600, 400), f"Expected 600x400, got {img.size}"
+                assert img.format == 'JPEG', f"Expected JPEG, got {img.format}"
+        
+            # A second run finds the .jpg under the .png name it would have used and skips it
+            with stub_session_get(lambda url, **kwargs: FakeResponse(500)) as calls:
+                assert download_flags.download_image(img_data, 1), "Existing file should count as success"
+                assert download_flags.download_image(img_data, 1, download_flags.list_existing_files())
+            assert calls == [], "Existing image should not be downloaded again"
+        
+            # A download that fails mid-stream leaves no partial file behind
+            with stub_session_get(lambda url, **kwargs: FakeResponse(200, raw=_FailingRaw())):
+                assert not download_flags.download_image(img_data, 2), "Broken download should fail"
+            assert sorted(os.listdir('flags')) == ['001_x.jpg'], f".part file left behind: {os.listdir('flags')}"
+            
+            # A thumbnail whose body fails mid-stream falls back to the original URL
+            thumb_data = {'url': 'https://upload.wikimedia.org/wikipedia/commons/thumb/5/5c/Flag_of_X.svg/125px-Flag_of_X.svg.png',
+                          'alt': 'X', 'width': '125', 'height': '83'}
+            for error in (OSError("connection reset"), urllib3.exceptions.ProtocolError("connection broken")):
+                def fake_get(url, **kwargs):
+                    if '/600px-' in url:
+                        return FakeResponse(200, raw=_FailingRaw(error))
+                    return FakeResponse(200, _png_bytes(125, 83))
+                with in_temp_dir():
+                    download_flags.create_output_directory()
+                    with stub_session_get(fake_get) as calls:
+                        assert download_flags.download_image(thumb_data, 1), f"Fallback should succeed after {error!r}"
+                    assert [url for url, _ in calls] == [thumb_data['url'].replace('/125px-', '/600px-'), thumb_data['url']], \
+                        f"Expected thumbnail then original request, got {calls}"
+                    assert os.listdir('flags') == ['001_X.png'], f"Unexpected files: {os.listdir('flags')}"
+    finally:
+        download_flags.RATE_LIMITER.interval = interval
+    
+    print("✓ Image download test passed")
+
+
+def test_resize_image():
+    """Test that resize_image reports the path it actually wrote."""
+    print("\nTesting image resizing...")
+    
+    with in_temp_dir():
+        with open('big.png.part', 'wb') as f:
+            f.write(_png_bytes(1200, 800))
+        assert download_flags.resize_image('big.png.part', 'big.png') == 'big.jpg', "Re-encoded image should be .jpg"
+        
+        with open('small.png.part', 'wb') as f:
+            f.write(_png_bytes(120, 80))
+        assert download_flags.resize_image('small.png.part', 'small.png') == 'small.png', "Small image should be kept as-is"
+        assert sorted(os.listdir('.')) == ['big.jpg', 'small.png'], f"Unexpected files: {os.listdir('.')}"
+    
+    print("✓ Image resizing test passed")
+
+
+def test_rate_limiter():
+    """Test that RateLimiter spaces out requests made from several threads."""
+    print("\nTesting rate limiter...")
+    interval = 0.05
+    limiter = download_flags.RateLimiter(interval)
+    start_times = []
+    lock = threading.Lock()
+    
+    def worker():
+        limiter.wait()
+        with lock:
+            start_times.append(time.monotonic())
+    
+    threads = [threading.Thread(target=worker) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    start_times.sort()
+    gaps = [later - earlier for earlier, later in zip(start_times, start_times[1:])]
+    # Allow a little scheduling jitter between a thread waking up and recording its time
+    assert all(gap >= interval * 0.8 for gap in gaps), f"Requests started too close together: {gaps}"
+    assert start_times[-1] - start_times[0] >= interval * (len(threads) - 1) * 0.95, "Total span too short"
+    
+    print("✓ Rate limiter test passed")
+
+
+def test_download_all_interrupt():
+    """Test that Ctrl-C cancels queued downloads instead of waiting for all of them."""
+    print("\nTesting interrupted parallel download...")
+    flag_images = [{'url': f'https://example.org/{i}.png', 'alt': str(i)} for i in range(40)]
+    started = []
+    
+    def fake_download_image(img_data, index, existing_files=None):
+        started.append(index)
+        if index == 1:
+            raise KeyboardInterrupt
+        time.sleep(0.05)
+        return True
+    
+    original = download_flags.download_image
+    download_flags.download_image = fake_download_image
+    try:
+        download_flags.download_all(flag_images)
+        raise AssertionError("KeyboardInterrupt should propagate")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        download_flags.download_image = original
+    
+    assert len(started) < len(flag_images), f"All {len(started)} downloads ran after the interrupt"
+    
+    print("✓ Interrupted download test passed")
+
+
 if __name__ == "__main__":
     print("="*60)
     print("Running tests for flag download functionality")
     print("="*60)
     
     test_extract_flag_images()
+    test_extract_flag_images_lxml()
+    test_extract_flag_images_fallback()
+    test_extract_flag_images_skips_empty_src()
     test_sanitize_filename()
+    test_get_thumbnail_url()
+    test_fetch_with_cache()
+    test_parsed_cache()
+    test_resize_image()
+    test_download_image()
+    test_rate_limiter()
+    test_download_all_interrupt()
     
     print("\n" + "="*60)
     print("All tests passed! ✓")
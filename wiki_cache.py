@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Shared HTTP session and on-disk cache for pages fetched from Wikipedia.
+
+The list of national flags is cached in cache/list_page.html and reused while
+it is fresh; after that it is revalidated with a conditional GET. Results parsed
+from a page can be stored alongside it so they are only recomputed when the
+page itself changes.
+"""
+
+import os
+import json
+import hashlib
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Configuration
+WIKIPEDIA_URL = "https://en.wikipedia.org/wiki/List_of_national_flags_of_sovereign_states"
+CACHE_DIR = "cache"
+ETAG_CACHE_FILE = os.path.join(CACHE_DIR, "etags.json")
+LIST_PAGE_CACHE_FILE = os.path.join(CACHE_DIR, "list_page.html")
+LIST_PAGE_MAX_AGE = 6 * 60 * 60  # Seconds a cached list page is used without revalidating
+USER_AGENT = 'AnkiVexillologyBot/1.0 (Educational purposes; downloading flag images)'
+
+
+def create_session():
+    """Create a requests session that reuses connections and retries transient errors."""
+    session = requests.Session()
+    session.headers.update({'User-Agent': USER_AGENT})
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+
+# Shared session so every request reuses the same TCP/TLS connections
+SESSION = create_session()
+
+
+def load_etag_cache():
+    """
+    Load the URL -> {etag, last_modified, body_path} cache from disk.
+    An unreadable file is treated as empty, and malformed entries are dropped.
+    """
+    try:
+        with open(ETAG_CACHE_FILE, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return {
+        url: entry for url, entry in cache.items()
+        if isinstance(entry, dict) and isinstance(entry.get('body_path'), str)
+    }
+
+
+def save_etag_cache(cache):
+    """Write the ETag cache to disk."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(ETAG_CACHE_FILE, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, indent=2)
+
+
+def fetch_with_cache(url, body_path=None, max_age=0, refresh=False):
+    """
+    Fetch a URL as text, caching the body on disk.
+    
+    A cached body younger than max_age seconds is returned without any request.
+    Otherwise If-None-Match/If-Modified-Since are sent so an unchanged page is
+    answered with 304 Not Modified and read back from the local cache.
+    With refresh=True the cached copy is ignored and the page is downloaded again.
+    """
+    cache = load_etag_cache()
+    entry = cache.get(url)
+    
+    headers = {}
+    if entry and not refresh and os.path.exists(entry['body_path']):
+        if time.time() - os.path.getmtime(entry['body_path']) < max_age:
+            print("  Using cached copy")
+            with open(entry['body_path'], 'r', encoding='utf-8') as f:
+                return f.read()
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    
+    response = SESSION.get(url, headers=headers)
+    if response.status_code == 304:
+        print("  Page not modified, using cached copy")
+        # Restart the freshness window now that the copy has been revalidated
+        os.utime(entry['body_path'])
+        with open(entry['body_path'], 'r', encoding='utf-8') as f:
+            return f.read()
+    response.raise_for_status()
+    
+    if body_path is None:
+        body_path = os.path.join(CACHE_DIR, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.html')
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(body_path, 'w', encoding='utf-8') as f:
+        f.write(response.text)
+    cache[url] = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'body_path': body_path
+    }
+    save_etag_cache(cache)
+    
+    return response.text
+
+
+def get_wikipedia_page(refresh=False):
+    """Fetch the Wikipedia page content."""
+    print(f"Fetching page: {WIKIPEDIA_URL}")
+    return fetch_with_cache(WIKIPEDIA_URL, LIST_PAGE_CACHE_FILE, LIST_PAGE_MAX_AGE, refresh)
+
+
+def _content_hash(text):
+    """Return a short fingerprint of a page's content."""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _parsed_cache_path(name):
+    """Return the path of the cache file for parsed data called name."""
+    return os.path.join(CACHE_DIR, f"{name}.json")
+
+
+def load_parsed(name, html_content, version):
+    """
+    Return the data saved by save_parsed for this exact page content and version,
+    or None if there is no matching entry or the cache file is unreadable.
+    """
+    try:
+        with open(_parsed_cache_path(name), 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict):
+        return None
+    if cached.get('version') != version or cached.get('hash') != _content_hash(html_content):
+        return None
+    return cached.get('data')
+
+
+def save_parsed(name, html_content, version, data):
+    """
+    Cache JSON-serializable data parsed from html_content so it can be reused until
+    the page changes. Bump version whenever the parser's output changes.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(_parsed_cache_path(name), 'w', encoding='utf-8') as f:
+        json.dump({'version': version, 'hash': _content_hash(html_content), 'data': data}, f)